@@ -13,6 +13,39 @@ FILES = [
     'references.md'
 ]
 OUTPUT_DOCX = 'manifesto.docx'
+COMBINED_MD = 'debug_combined.md'
+
+_FILES_SET = frozenset(FILES)
+
+# Regex for markdown links: [text](url){ #id } or [text](url)
+# Only links that need rewriting are matched: local .md links (split into
+# file and anchor) and links of any kind carrying an attribute part.
+# Possessive quantifiers (Python 3.11+) keep malformed links from backtracking.
+_LINK_RE = re.compile(
+    r'\[(?P<text>[^\]]++)\]'
+    r'\((?P<url>(?!http)(?P<file>[^)#]*\.md)(?:#(?P<anchor>[^)#]*+))?(?=\))|[^)]++(?=\)\s*+\{ *+#))\)'
+    r'(?P<attr>\s*+\{ *+#[^}]++\})?'
+)
+
+# Regex for checkboxes, either id-based or name-based
+# <input type='checkbox' checked id="cb-1-1" class="cb-sa" onchange="toggleCheckboxes(event)"/>
+# <input type='checkbox' checked name="pledge_1_1_1" class="data-input" />
+# The id lookahead is tried first, so an input with both attributes keeps its
+# id, wherever the attributes appear in the tag
+_CB_RE = re.compile(r'<input(?:(?=[^>]+id="(?P<cb>cb-[^"]+)")|(?=[^>]+name="(?P<pl>pledge_[^"]+)"))[^>]*>')
+
+# Regex to detect block start/end
+# Starts with optional whitespace, then /// then space then something
+_BLOCK_START_RE = re.compile(r'^\s*///\s+\w+')
+# Starts with optional whitespace, then /// and nothing else (except whitespace)
+_BLOCK_END_RE = re.compile(r'^\s*///\s*$')
+
+# Content lines starting with these get a blank line after them
+_SEPARATE_PARAGRAPH_PREFIXES = ('type:', 'open:', '<input', '[cb-', '[pledge_')
+
+# Translation table for escape_html: '&' is escaped too, in the same pass,
+# so that existing entities survive as literal text
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
 
 def process_links(content, current_file):
     """
@@ -20,212 +53,193 @@ def process_links(content, current_file):
     [Text](other.md#anchor) -> [Text](#anchor)
     [Text](other.md) -> [Text](#file-anchor)
     """
+    # Only .md links and links with { #id } attributes are rewritten;
+    # skip the regex for content that can contain neither
+    if '.md' not in content and '{' not in content:
+        return content
+    
     def replace_link(match):
-        text = match.group(1)
-        url = match.group(2)
-        attr = match.group(3) # Optional attributes like { #id }
+        text = match.group('text')
+        filename = match.group('file')
+        anchor = match.group('anchor')
+        attr = match.group('attr') # Optional attributes like { #id }
         
         # If attributes exist, append them to text so they survive DOCX roundtrip
         if attr:
             text = f"{text} {attr.strip()}"
         
-        # Check if it's a local markdown file link
-        if '.md' in url and not url.startswith('http'):
-            parts = url.split('#')
-            filename = parts[0]
-            anchor = parts[1] if len(parts) > 1 else None
-            
-            # If it links to one of our files
-            if filename in FILES:
-                if filename == current_file:
-                    # Internal link to same file
-                    if anchor:
-                        return f'[{text}](#{anchor})'
-                    else:
-                        # Link to top of same file?
-                        # Usually [Text](file.md) means top.
-                        # We can just leave it as #file-anchor (the one we added)
-                        file_anchor = filename.replace('.', '-').lower()
-                        return f'[{text}](#{file_anchor})'
+        # If it is a local markdown link to one of our files
+        if filename in _FILES_SET:
+            if filename == current_file:
+                # Internal link to same file
+                if anchor:
+                    return f'[{text}](#{anchor})'
                 else:
-                    # Cross-file link
-                    # Encode filename in anchor to preserve it for import
-                    # file.md -> file_md
-                    safe_filename = filename.replace('.', '_')
-                    if anchor:
-                        return f'[{text}](#{safe_filename}__{anchor})'
-                    else:
-                        return f'[{text}](#{safe_filename})'
-        
+                    # Link to top of same file?
+                    # Usually [Text](file.md) means top.
+                    # We can just leave it as #file-anchor (the one we added)
+                    file_anchor = filename.replace('.', '-').lower()
+                    return f'[{text}](#{file_anchor})'
+            else:
+                # Cross-file link
+                # Encode filename in anchor to preserve it for import
+                # file.md -> file_md
+                safe_filename = filename.replace('.', '_')
+                if anchor:
+                    return f'[{text}](#{safe_filename}__{anchor})'
+                else:
+                    return f'[{text}](#{safe_filename})'
+    
         # If we modified text (because of attr) or just want to return the link
         if attr:
-            return f'[{text}]({url})'
+            return f"[{text}]({match.group('url')})"
 
         return match.group(0)
 
-    # Regex for markdown links: [text](url){ #id } or [text](url)
-    # We capture the optional attribute part
-    return re.sub(r'\[([^\]]+)\]\(([^)]+)\)(\s*\{ *#[^}]+\})?', replace_link, content)
+    return _LINK_RE.sub(replace_link, content)
+
+def _replace_checkbox(match):
+    return f"[{match.group('cb') or match.group('pl')}]"
 
 def process_checkboxes(content):
     """
     Replaces <input ...> with [id] or [name] for cleaner DOCX.
     """
-    # Replace id-based checkboxes: [cb-X-Y]
-    # <input type='checkbox' checked id="cb-1-1" class="cb-sa" onchange="toggleCheckboxes(event)"/>
-    content = re.sub(r'<input[^>]+id="(cb-[^"]+)"[^>]*>', r'[\1]', content)
+    # Most lines have no input tag at all; skip the regex for them
+    if '<input' not in content:
+        return content
     
-    # Replace name-based checkboxes: [pledge_X_Y_Z]
-    # <input type='checkbox' checked name="pledge_1_1_1" class="data-input" />
-    content = re.sub(r'<input[^>]+name="(pledge_[^"]+)"[^>]*>', r'[\1]', content)
-    
-    return content
+    # Replace id-based checkboxes [cb-X-Y] and name-based checkboxes
+    # [pledge_X_Y_Z] in a single scan
+    return _CB_RE.sub(_replace_checkbox, content)
 
 def escape_html(content):
     """
     Escapes HTML tags so they appear as text in DOCX.
     """
-    content = content.replace('<', '&lt;')
-    content = content.replace('>', '&gt;')
-    return content
+    return content.translate(_HTML_ESCAPE_TABLE)
 
-def unindent_blocks(content):
+def unindent_line(line, state):
     """
     Flattens indentation for /// blocks while preserving logical structure.
+    Operates on a single line; state['stack_depth'] tracks the block nesting
+    across calls. Returns the output text, which may span two lines.
     """
-    lines = content.split('\n')
-    new_lines = []
-    stack_depth = 0
+    # Calculate current indentation (spaces)
+    current_indent = len(line) - len(line.lstrip(' '))
     
-    # Regex to detect block start/end
-    # Starts with optional whitespace, then /// then space then something
-    block_start_pattern = re.compile(r'^\s*///\s+\w+')
-    # Starts with optional whitespace, then /// and nothing else (except whitespace)
-    block_end_pattern = re.compile(r'^\s*///\s*$')
+    # Only lines containing /// can be tags; skip the regexes otherwise
+    has_tag = '///' in line
+    is_start = has_tag and _BLOCK_START_RE.match(line)
+    is_end = has_tag and _BLOCK_END_RE.match(line)
     
-    for i, line in enumerate(lines):
-        # Calculate current indentation (spaces)
-        current_indent = len(line) - len(line.lstrip(' '))
-        
-        is_start = block_start_pattern.match(line)
-        is_end = block_end_pattern.match(line)
+    if is_start:
+        # It's a start tag. 
+        state['stack_depth'] += 1
+        # We strip its indentation.
+        # Add a blank line to prevent merging with next line in DOCX
+        return line.strip() + '\n'
+    elif is_end:
+        # It's an end tag.
+        state['stack_depth'] -= 1
+        if state['stack_depth'] < 0: state['stack_depth'] = 0 # Safety
+        # Add a blank line to prevent merging
+        return line.strip() + '\n'
+    else:
+        # It's content.
+        # We remove indentation corresponding to the stack depth.
+        # Assuming 4 spaces per level.
+        indent_to_remove = state['stack_depth'] * 4
         
-        if is_start:
-            # It's a start tag. 
-            # We strip its indentation.
-            new_lines.append(line.strip())
-            # Add a blank line to prevent merging with next line in DOCX
-            new_lines.append('') 
-            stack_depth += 1
-        elif is_end:
-            # It's an end tag.
-            stack_depth -= 1
-            if stack_depth < 0: stack_depth = 0 # Safety
-            new_lines.append(line.strip())
-            # Add a blank line to prevent merging
-            new_lines.append('')
+        processed_line = ""
+        # Only remove if the line actually has that much indentation
+        if current_indent >= indent_to_remove:
+            processed_line = line[indent_to_remove:]
         else:
-            # It's content.
-            # We remove indentation corresponding to the stack depth.
-            # Assuming 4 spaces per level.
-            indent_to_remove = stack_depth * 4
-            
-            processed_line = ""
-            # Only remove if the line actually has that much indentation
-            if current_indent >= indent_to_remove:
-                processed_line = line[indent_to_remove:]
-            else:
-                if line.strip() == '':
-                    processed_line = ''
-                else:
-                    processed_line = line.lstrip()
-            
-            # Special handling for metadata lines and inputs to prevent merging
-            stripped_line = processed_line.strip()
-            if stripped_line.startswith('type:') or stripped_line.startswith('open:') or stripped_line.startswith('<input') or stripped_line.startswith('[cb-') or stripped_line.startswith('[pledge_'):
-                new_lines.append(processed_line)
-                new_lines.append('') # Add blank line to force separate paragraph
+            if line.strip() == '':
+                processed_line = ''
             else:
-                new_lines.append(processed_line)
-            
-            # If the NEXT line is a /// tag, we should ensure we have a blank line here too?
-            # Or if THIS line is the last line of a paragraph?
-            # To be safe, we could add blank lines between everything, but that makes the doc huge.
-            # The issue was mainly /// tags merging with content.
-            # By adding a blank line AFTER /// tags, we solve:
-            # /// details
-            # type: info
-            # ->
-            # /// details
-            # 
-            # type: info
-            
-            # And:
-            # ///
-            # /// html
-            # ->
-            # ///
-            # 
-            # /// html
-            
-            # This should be sufficient.
-
-    return '\n'.join(new_lines)
-
-def main():
-    full_content = []
-    
-    for filename in FILES:
-        filepath = os.path.join(DOCS_DIR, filename)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            content = f.read()
-            
-        print(f"Processing {filename}...")
-        
-        # 1. Add File Marker
-        file_anchor = filename.replace('.', '-').lower()
-        # We add a visible marker for the file start, and an anchor
-        # Using HTML comment for the marker to be hidden in DOCX? 
-        # No, we need it to split back. 
-        # Let's use a special string that looks like a header or comment.
-        # But user wants "readily editable".
-        # Let's use a custom XML-like tag that we can hide or just leave visible.
-        # "<!-- FILE: filename.md -->" might be stripped by Pandoc or Word.
-        # Let's use a bold text line.
-        header = f"\n\n**=== FILE: {filename} ===** {{#{file_anchor}}}\n\n"
+                processed_line = line.lstrip()
         
-        # 2. Process Links
-        content = process_links(content, filename)
+        # Special handling for metadata lines and inputs to prevent merging
+        if processed_line.strip().startswith(_SEPARATE_PARAGRAPH_PREFIXES):
+            processed_line += '\n' # Add blank line to force separate paragraph
         
-        # 3. Process Checkboxes
-        content = process_checkboxes(content)
+        # If the NEXT line is a /// tag, we should ensure we have a blank line here too?
+        # Or if THIS line is the last line of a paragraph?
+        # To be safe, we could add blank lines between everything, but that makes the doc huge.
+        # The issue was mainly /// tags merging with content.
+        # By adding a blank line AFTER /// tags, we solve:
+        # /// details
+        # type: info
+        # ->
+        # /// details
+        # 
+        # type: info
         
-        # 4. Unindent Blocks
-        content = unindent_blocks(content)
+        # And:
+        # ///
+        # /// html
+        # ->
+        # ///
+        # 
+        # /// html
         
-        # 5. Escape HTML
-        # We do this AFTER unindenting, because unindenting relies on spaces.
-        # But wait, unindenting doesn't care about content.
-        content = escape_html(content)
-        
-        # 5. Process Checkboxes
-        content = process_checkboxes(content)
-        
-        full_content.append(header + content)
+        # This should be sufficient.
 
-    combined_markdown = "".join(full_content)
+        return processed_line
+
+def process_file(filename):
+    """
+    Reads and transforms one source file.
+    Returns its file marker followed by the transformed content.
+    """
+    filepath = os.path.join(DOCS_DIR, filename)
+    print(f"Processing {filename}...")
+    
+    # 1. Add File Marker
+    file_anchor = filename.replace('.', '-').lower()
+    # We add a visible marker for the file start, and an anchor
+    # Using HTML comment for the marker to be hidden in DOCX? 
+    # No, we need it to split back. 
+    # Let's use a special string that looks like a header or comment.
+    # But user wants "readily editable".
+    # Let's use a custom XML-like tag that we can hide or just leave visible.
+    # "<!-- FILE: filename.md -->" might be stripped by Pandoc or Word.
+    # Let's use a bold text line.
+    header = f"\n\n**=== FILE: {filename} ===** {{#{file_anchor}}}\n\n"
+    
+    with open(filepath, 'r', encoding='utf-8') as f:
+        content = f.read()
+    
+    # 2. Process Links and Checkboxes
+    # These run on the whole file, since a link text or an input tag can
+    # span a line break.
+    content = process_links(content, filename)
+    content = process_checkboxes(content)
     
-    # Save intermediate markdown for debugging
-    with open('debug_combined.md', 'w', encoding='utf-8') as f:
-        f.write(combined_markdown)
+    # 3. Unindent Blocks and Escape HTML, line by line in a single pass.
+    # Escape HTML AFTER unindenting, because unindenting relies on spaces.
+    state = {'stack_depth': 0}
+    content = '\n'.join(escape_html(unindent_line(line, state)) for line in content.split('\n'))
+    
+    return header + content
+
+def main():
+    # The combined markdown is written to disk file by file and handed to
+    # pandoc from there, so only one transformed file is held in memory.
+    # It doubles as the intermediate markdown for debugging.
+    with open(COMBINED_MD, 'w', encoding='utf-8') as combined:
+        for filename in FILES:
+            combined.write(process_file(filename))
         
     print("Converting to DOCX...")
     # Convert to DOCX
     # We use 'markdown' format. 
     # We might need extensions. 'markdown+raw_html' might be needed if we didn't escape.
     # Since we escaped, standard markdown should treat &lt; as literal <.
-    pypandoc.convert_text(
-        combined_markdown, 
+    pypandoc.convert_file(
+        COMBINED_MD, 
         'docx', 
         format='markdown', 
         outputfile=OUTPUT_DOCX
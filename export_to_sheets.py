@@ -11,18 +11,6 @@ SUPABASE_SERVICE_ROLE_KEY = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
 GOOGLE_SHEETS_CREDENTIALS = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')  # JSON string
 GOOGLE_SHEET_ID = os.environ.get('GOOGLE_SHEET_ID')  # The ID from the sheet URL
 
-# Define columns to exclude (identifying information)
-EXCLUDED_COLUMNS = [
-    'show_name',
-    'created_at',
-    'first_name', 
-    'last_name',
-    'affiliation',
-    'email',
-    'orcid',
-    'comment',  # May contain identifying information
-]
-
 # Define identifier columns for long format
 IDENTIFIER_COLUMNS = [
     'id',
@@ -33,74 +21,86 @@ IDENTIFIER_COLUMNS = [
     'country_of_residence'
 ]
 
-def fetch_all_submissions():
-    """Fetches all submissions from Supabase using the service_role key."""
+# Columns of the long format export (A-H)
+HEADERS = IDENTIFIER_COLUMNS + ['pledge', 'value']
+
+# Number of sheet rows written per range in the batch update
+UPLOAD_CHUNK_SIZE = 5000
+
+# Number of rows fetched from Supabase per request
+PAGE_SIZE = 1000
+
+def fetch_submission_pages():
+    """Fetches the anonymized columns of all submissions from Supabase using the service_role key.
+    
+    Rows are fetched PAGE_SIZE at a time and yielded page by page, so only one
+    page of wide rows is held at a time. Yields None and stops if a fetch fails.
+    """
     if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
         raise ValueError("Supabase URL or Service Role Key environment variables are not set.")
 
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
     try:
-        # Fetch all data from signatories table
-        response = supabase.table('signatories').select('*').execute()
+        # Look up the pledge columns from a single row, so that only the
+        # anonymized columns (identifiers and pledges) are fetched for all rows.
+        # That one sample row is read in full, including its identifying
+        # columns (names, affiliation, email, orcid, comment, ...), so it is
+        # reduced to its column names right away and its values are dropped.
+        sample = supabase.table('signatories').select('*').limit(1).execute()
+        if not sample.data:
+            print(f"Error fetching data from Supabase: {sample.error}")
+            yield None
+            return
+        keep_cols = IDENTIFIER_COLUMNS + [c for c in sample.data[0] if c.startswith('pledge_')]
+        del sample
         
-        if response.data:
-            print(f"Fetched {len(response.data)} records from Supabase")
-            return response.data
-        else:
-            print(f"Error fetching data from Supabase: {response.error}")
-            return None
+        # Fetch the anonymized columns from signatories table, one page at a time.
+        # Ordering by id keeps the pages stable.
+        offset = 0
+        while True:
+            response = supabase.table('signatories') \
+                               .select(','.join(keep_cols)) \
+                               .order('id') \
+                               .range(offset, offset + PAGE_SIZE - 1) \
+                               .execute()
+            
+            if not response.data:
+                break
+            print(f"Fetched {len(response.data)} records from Supabase (offset {offset})")
+            yield response.data
+            
+            if len(response.data) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
     except Exception as e:
         print(f"An unexpected error occurred during Supabase fetch: {e}")
-        return None
-
-def anonymize_data(data):
-    """Remove identifying columns from the data."""
-    if not data:
-        return []
-    
-    anonymized = []
-    for row in data:
-        # Create a new dict without excluded columns
-        anon_row = {k: v for k, v in row.items() if k not in EXCLUDED_COLUMNS}
-        anonymized.append(anon_row)
-    
-    print(f"Anonymized {len(anonymized)} records")
-    print(f"Excluded columns: {', '.join(EXCLUDED_COLUMNS)}")
-    
-    return anonymized
+        yield None
 
 def convert_to_long_format(data):
     """Convert wide format data to long format.
     
     Identifier columns will be repeated for each pledge column.
-    Each row will have: identifier columns + pledge_name + pledge_value
+    Each row is a list in HEADERS order: identifier columns + pledge_name + pledge_value
     """
     if not data:
         return []
     
-    long_data = []
+    # All rows are fetched with the same columns, so the pledge columns
+    # are looked up once instead of filtering every row
+    pledge_names = [k for k in data[0] if k.startswith('pledge_')]
     
+    # Every record yields one row per pledge, so the output size is known upfront
+    long_data = [None] * (len(data) * len(pledge_names))
+    i = 0
     for row in data:
-        # Get all pledge columns from this row
-        pledge_columns = {k: v for k, v in row.items() if k.startswith('pledge_')}
+        # Identifier values are read once per record, straight from the raw row
+        id_values = [row.get(id_col) for id_col in IDENTIFIER_COLUMNS]
         
-        # Create a row for each pledge
-        for pledge_name, pledge_value in pledge_columns.items():
-            long_row = {}
-            
-            # Add identifier columns
-            for id_col in IDENTIFIER_COLUMNS:
-                long_row[id_col] = row.get(id_col)
-            
-            # Add pledge name and value
-            long_row['pledge'] = pledge_name
-            long_row['value'] = pledge_value
-            
-            long_data.append(long_row)
-    
-    print(f"Converted to long format: {len(long_data)} rows from {len(data)} records")
-    print(f"Each record has {len(long_data) // len(data) if data else 0} pledge entries")
+        # Create a row for each pledge: identifier columns + pledge name and value
+        for pledge_name in pledge_names:
+            long_data[i] = id_values + [pledge_name, row.get(pledge_name)]
+            i += 1
     
     return long_data
 
@@ -122,20 +122,13 @@ def export_to_google_sheets(data):
         )
         
         # Build the Sheets API service
-        service = build('sheets', 'v4', credentials=credentials)
+        # The discovery document is not cached on disk (the script runs once per job)
+        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
         sheet = service.spreadsheets()
         
-        # Get column headers from first record
         if data:
-            headers = list(data[0].keys())
-            
-            # Limit to first 8 columns (A-H)
-            headers = headers[:8]
-            
-            # Prepare data for sheets (convert to list of lists)
-            values = [headers]  # First row is headers
-            for row in data:
-                values.append([row.get(col) for col in headers])
+            # Rows are already lists in HEADERS order (columns A-H)
+            values = [HEADERS] + data  # First row is headers
             
             # Clear existing data first (only columns A-H)
             try:
@@ -146,19 +139,25 @@ def export_to_google_sheets(data):
             except HttpError as clear_error:
                 print(f"Warning: Could not clear sheet (may be empty): {clear_error}")
             
-            # Write the data to columns A-H
+            # Write the data to columns A-H, split into ranges of UPLOAD_CHUNK_SIZE rows
+            # sent together in a single batch update
             body = {
-                'values': values
+                'valueInputOption': 'RAW',
+                'data': [
+                    {
+                        'range': f'SignatureData!A{start + 1}:H{min(start + UPLOAD_CHUNK_SIZE, len(values))}',
+                        'values': values[start:start + UPLOAD_CHUNK_SIZE]
+                    }
+                    for start in range(0, len(values), UPLOAD_CHUNK_SIZE)
+                ]
             }
-            result = sheet.values().update(
+            result = sheet.values().batchUpdate(
                 spreadsheetId=GOOGLE_SHEET_ID,
-                range='SignatureData!A1:H',
-                valueInputOption='RAW',
                 body=body
             ).execute()
             
-            print(f"Successfully exported {result.get('updatedRows')} rows to Google Sheets (columns A-H)")
-            print(f"Columns included: {', '.join(headers)}")
+            print(f"Successfully exported {result.get('totalUpdatedRows')} rows to Google Sheets (columns A-H)")
+            print(f"Columns included: {', '.join(HEADERS)}")
             
     except HttpError as error:
         print(f"An error occurred with Google Sheets API: {error}")
@@ -172,18 +171,19 @@ def main():
     print("Starting anonymized data export to Google Sheets...")
     print("-" * 60)
     
-    # Fetch data from Supabase
-    data = fetch_all_submissions()
-    
-    if data is None:
-        print("Failed to fetch data. Exiting.")
-        return
-    
-    # Anonymize the data
-    anonymized_data = anonymize_data(data)
-    
-    # Convert to long format
-    long_format_data = convert_to_long_format(anonymized_data)
+    # Fetch data from Supabase page by page and convert each page to long format.
+    # The long-format rows of all pages are kept for the single upload below.
+    long_format_data = []
+    num_records = 0
+    for page in fetch_submission_pages():
+        if page is None:
+            print("Failed to fetch data. Exiting.")
+            return
+        num_records += len(page)
+        long_format_data.extend(convert_to_long_format(page))
+    
+    print(f"Converted to long format: {len(long_format_data)} rows from {num_records} records")
+    print(f"Each record has {len(long_format_data) // num_records if num_records else 0} pledge entries")
     
     # Export to Google Sheets
     export_to_google_sheets(long_format_data)
@@ -1,10 +1,13 @@
 import re
 import os
+import functools
 import pypandoc
 
 # Configuration
 DOCS_DIR = 'docs'
 INPUT_DOCX = 'manifesto.docx'
+# Intermediate markdown written by pandoc, also kept for debugging
+IMPORT_MD = 'debug_import_full.md'
 FILES = [
     'introduction.md',
     'validity.md',
@@ -14,82 +17,104 @@ FILES = [
     'references.md'
 ]
 
-def build_anchor_map(content):
+# Encoded filename (file.md -> file_md) used in link anchors, mapped back to the file
+_SAFE_TO_FILE = {filename.replace('.', '_'): filename for filename in FILES}
+
+# Regex for file marker
+_FILE_MARKER_RE = re.compile(r'\*\*=== FILE: ([\w\.-]+) ===\*\*')
+
+# Regex for /// blocks
+# We need to handle escaped pipe \|
+# block_start: /// details ... or /// html ...
+# Capture the type (group 1), the selector after | if any (group 2, e.g. li
+# or ul.tasklist) and the rest of the line (group 3)
+_BLOCK_START_RE = re.compile(r'^\s*///\s+(\w+)(?:\s*\|\s*(\S+))?(.*)')
+_BLOCK_END_RE = re.compile(r'^\s*///\s*$')
+
+# Indent of the content of /// html blocks, by selector (default 4)
+# ul.tasklist indents children by 2
+# li indents content by 2 (relative to its own indent)
+_HTML_INDENT = {'ul.tasklist': 2, 'li': 2}
+
+# Trailing /// tag merged into a line by pypandoc (preceded by a space).
+# Group 1 is the tag; the text before it must not be blank.
+_TRAIL_TAG_RE = re.compile(r'\s(///\s*)$')
+
+# Characters escaped by pandoc (\| \< \> \_ \[ \]) and non-breaking spaces
+_UNESCAPE_RE = re.compile(r'\\([|<>_\[\]])|\u00A0')
+
+def _unescape(match):
+    # Non-breaking space -> space, escaped character -> character
+    return match.group(1) or ' '
+
+# Indentation strings for the usual (small) indent levels, built once
+_INDENTS = tuple(' ' * n for n in range(64))
+
+def indent_str(n):
+    """Returns n spaces, from the prebuilt table when possible."""
+    return _INDENTS[n] if n < len(_INDENTS) else ' ' * n
+
+# Regex for encoded internal links: [Text](#anchor)
+_LINK_RE = re.compile(r'\[([^\]]+)\]\(#([\w\.-]+)\)')
+
+# Regex for attributes hidden in link text: [Text { #id }](url)
+# We need to be careful about the text part.
+# It ends with { #id }, and may not contain brackets, so a match cannot start
+# at an earlier, unrelated [ on the same line (and cannot backtrack across it).
+_ATTR_RE = re.compile(r'\[([^\[\]]*?) \{ *(#[^}]+?) *\}\]\(([^)]+)\)')
+
+# Regex for [cb-...]
+_CB_RE = re.compile(r'\[(cb-[^\]]+)\]')
+# Regex for [pledge_...]
+_PLEDGE_RE = re.compile(r'\[(pledge_[^\]]+)\]')
+
+def read_lines(path):
     """
-    Scans the content to map anchors to filenames.
-    (Kept for reference, though link restoration now uses encoding)
+    Yields the lines of a file without their trailing newline, one at a time,
+    matching content.split('\n') on the whole file.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        line = ''
+        for line in f:
+            yield line[:-1] if line.endswith('\n') else line
+        if line == '' or line.endswith('\n'):
+            yield ''
+
+def split_trailing_tags(lines):
+    """
+    Pre-process to split trailing /// that might have been merged by pypandoc.
+    Yields the lines one at a time instead of building a second list.
     """
-    anchor_map = {}
-    current_file = None
-    
-    # Regex for file marker
-    file_marker_pattern = re.compile(r'\*\*=== FILE: ([\w\.-]+) ===\*\*')
-    
-    # Regex for headers with attributes: ## Header {#anchor}
-    # Pandoc output: ## Header {#anchor}
-    # Or just {#anchor} at end of line
-    anchor_pattern = re.compile(r'\{#([\w\.-]+)\}')
-    
-    lines = content.split('\n')
     for line in lines:
-        # Check for file marker
-        m_file = file_marker_pattern.search(line)
-        if m_file:
-            current_file = m_file.group(1)
-            continue
-            
-        if current_file:
-            # Check for anchors
-            anchors = anchor_pattern.findall(line)
-            for anchor in anchors:
-                anchor_map[anchor] = current_file
-                
-    return anchor_map
+        # Most lines have no /// at all; skip the regex for them
+        m = _TRAIL_TAG_RE.search(line) if '///' in line else None
+        if m and line[:m.start(1)].strip():
+            yield line[:m.start(1)]
+            yield line[m.start(1):]
+        else:
+            yield line
 
-def process_content(content, anchor_map):
+def process_content(lines):
     """
     Splits content into files, re-indents blocks, restores links and HTML.
     """
     files_content = {}
     current_file = None
     current_buffer = []
+    # Bound once; the loop appends for every line
+    append = current_buffer.append
     
     # Stack for indentation
     # We push the expected indentation level (in spaces)
     # But we also need to know the block type to decide whether to indent content.
-    # Stack items: (indent_level, block_type)
-    indent_stack = [(0, None)] 
-    
-    # Regex for file marker
-    file_marker_pattern = re.compile(r'\*\*=== FILE: ([\w\.-]+) ===\*\*')
-    
-    # Regex for /// blocks
-    # We need to handle escaped pipe \|
-    # block_start: /// details ... or /// html ...
-    # Capture the type (group 1) and the rest of the line (group 2)
-    block_start_pattern = re.compile(r'^\s*///\s+(\w+)(.*)')
-    block_end_pattern = re.compile(r'^\s*///\s*$')
-    
-    # Pre-process to split trailing /// that might have been merged by pypandoc
-    split_lines = []
-    for line in content.split('\n'):
-        stripped = line.strip()
-        if stripped.endswith('///') and stripped != '///':
-            # Check if it's really a tag (preceded by space)
-            if re.search(r'\s///\s*$', line):
-                idx = line.rfind('///')
-                split_lines.append(line[:idx])
-                split_lines.append(line[idx:])
-            else:
-                split_lines.append(line)
-        else:
-            split_lines.append(line)
-            
-    lines = split_lines
+    # Kept as two parallel stacks (indent levels, block types) to avoid
+    # building and unpacking a tuple per line
+    indent_stack_n = [0]
+    indent_stack_t = [None]
     
-    for line in lines:
+    for line in split_trailing_tags(lines):
         # 1. Check for file marker
-        m_file = file_marker_pattern.search(line)
+        m_file = _FILE_MARKER_RE.search(line) if '**=== FILE:' in line else None
         if m_file:
             # Save previous buffer
             if current_file:
@@ -97,37 +122,36 @@ def process_content(content, anchor_map):
             
             current_file = m_file.group(1)
             current_buffer = []
-            indent_stack = [(0, None)] # Reset stack for new file
+            append = current_buffer.append
+            # Reset stack for new file
+            indent_stack_n = [0]
+            indent_stack_t = [None]
             continue
             
         if current_file is None:
             continue # Skip preamble if any
             
-        # 2. Unescape characters
-        line = line.replace(r'\|', '|')
-        line = line.replace(r'\<', '<')
-        line = line.replace(r'\>', '>')
-        line = line.replace(r'\_', '_')
-        line = line.replace(r'\[', '[')
-        line = line.replace(r'\]', ']')
-        line = line.replace('\u00A0', ' ') # Replace non-breaking space
+        # 2. Unescape characters and replace non-breaking spaces
+        line = _UNESCAPE_RE.sub(_unescape, line)
         
         # Remove trailing backslash (hard break from pandoc)
         if line.endswith('\\'):
             line = line[:-1]
         
         # 3. Handle Indentation Logic
-        # Check if it's a block start/end
-        is_start = block_start_pattern.match(line)
-        is_end = block_end_pattern.match(line)
+        # Check if it's a block start/end (only lines containing /// can be)
+        has_tag = '///' in line
+        is_start = _BLOCK_START_RE.match(line) if has_tag else None
+        is_end = _BLOCK_END_RE.match(line) if has_tag else None
         
-        current_indent, current_block_type = indent_stack[-1]
+        current_indent = indent_stack_n[-1]
+        current_block_type = indent_stack_t[-1]
         
         if is_start:
             # It's a start tag. Print with current indent.
             # Then increase indent for NEXT lines.
             block_type = is_start.group(1)
-            rest_of_tag = is_start.group(2)
+            selector = is_start.group(2)
             
             # Determine indentation for the start tag itself
             # Logic:
@@ -137,67 +161,58 @@ def process_content(content, anchor_map):
             
             tag_indent = current_indent
             
-            indented_line = (' ' * tag_indent) + line
-            current_buffer.append(indented_line)
+            indented_line = indent_str(tag_indent) + line
+            append(indented_line)
             
             # Calculate indent for content inside this new block
             new_indent = tag_indent
             if block_type == 'html':
-                if 'ul.tasklist' in rest_of_tag:
-                    new_indent += 2 # ul.tasklist indents children by 2
-                elif 'li' in rest_of_tag: # Assuming /// html | li
-                    new_indent += 2 # li indents content by 2 (relative to its own indent)
-                else:
-                    new_indent += 4 # Default html indent
+                new_indent += _HTML_INDENT.get(selector, 4) # Default html indent is 4
             elif block_type == 'details':
                 new_indent += 0 # details blocks DO NOT indent their content (except metadata)
             else:
                 new_indent += 4 # Default to indenting
                 
-            indent_stack.append((new_indent, block_type))
+            indent_stack_n.append(new_indent)
+            indent_stack_t.append(block_type)
             
         elif is_end:
             # It's an end tag.
             # Pop stack first (return to previous indent level)
-            if len(indent_stack) > 1:
-                indent_stack.pop()
+            if len(indent_stack_n) > 1:
+                indent_stack_n.pop()
+                indent_stack_t.pop()
             
             # The end tag should match the indent of the start tag
             # Which is the indent level of the PARENT
-            parent_indent, _ = indent_stack[-1]
+            parent_indent = indent_stack_n[-1]
             
-            indented_line = (' ' * parent_indent) + line
-            current_buffer.append(indented_line)
+            indented_line = indent_str(parent_indent) + line
+            append(indented_line)
         else:
             # Normal line. Apply current indent?
             
+            # Strip once; the checks below reuse it
+            stripped = line.strip()
+            
             # Special handling for metadata lines in 'details' blocks
             # type: ... and open: ... should be indented 4 spaces
             if current_block_type == 'details':
-                stripped = line.strip()
-                if stripped.startswith('type:') or stripped.startswith('open:'):
+                if stripped.startswith(('type:', 'open:')):
                     # Indent 4 spaces
-                    indented_line = (' ' * (current_indent + 4)) + line
+                    indented_line = indent_str(current_indent + 4) + line
                 else:
                     # Normal content in details -> No indent (current_indent is 0 relative to block)
-                    indented_line = (' ' * current_indent) + line
+                    indented_line = indent_str(current_indent) + line
             else:
                 # Normal content in other blocks (html) -> Apply indent
-                if line.strip() == '':
-                    current_buffer.append('')
+                if not stripped:
+                    append('')
                     continue
-                else:
-                    # Strip leading whitespace from the line to avoid double indentation
-                    stripped_line = line.lstrip()
-                    
-                    # Special handling for metadata in details blocks
-                    # They must be indented even if the block content is 0-indented
-                    if current_block_type == 'details' and (stripped_line.startswith('type:') or stripped_line.startswith('open:')):
-                        indented_line = (' ' * (current_indent + 4)) + stripped_line
-                    else:
-                        indented_line = (' ' * current_indent) + stripped_line
+                # Strip leading whitespace from the line to avoid double indentation
+                indented_line = indent_str(current_indent) + line.lstrip()
             
-            current_buffer.append(indented_line)
+            append(indented_line)
                 
     # Save last file
     if current_file:
@@ -205,141 +220,140 @@ def process_content(content, anchor_map):
         
     return files_content
 
-def restore_links(content_lines, anchor_map, current_file):
+def _replace_link(match, current_file):
+    text = match.group(1)
+    anchor = match.group(2)
+    
+    # Check for encoded filename
+    # Pattern: filename_md__anchor OR filename_md
+    
+    # Look up the file prefix
+    target_file = None
+    real_anchor = None
+    
+    head, sep, tail = anchor.partition('__')
+    if head in _SAFE_TO_FILE:
+        target_file = _SAFE_TO_FILE[head]
+        real_anchor = tail if sep else None
+    
+    if target_file:
+        if target_file == current_file:
+            # Should be internal link
+            if real_anchor:
+                return f'[{text}](#{real_anchor})'
+            else:
+                # Link to top of current file
+                return f'[{text}](#)' # Or just remove link?
+        else:
+            # Cross-file link
+            if real_anchor:
+                return f'[{text}]({target_file}#{real_anchor})'
+            else:
+                return f'[{text}]({target_file})'
+    
+    # If not encoded, it's a regular internal link
+    return match.group(0)
+
+def restore_links(line, current_file):
     """
     Restores cross-file links using encoded anchors.
     [Text](#file_md__anchor) -> [Text](file.md#anchor)
     [Text](#file_md) -> [Text](file.md)
     """
-    new_lines = []
-    link_pattern = re.compile(r'\[([^\]]+)\]\(#([\w\.-]+)\)')
-    
-    def replace_link(match):
-        text = match.group(1)
-        anchor = match.group(2)
-        
-        # Check for encoded filename
-        # Pattern: filename_md__anchor OR filename_md
-        
-        # Try to find a matching file prefix
-        target_file = None
-        real_anchor = None
-        
-        for filename in FILES:
-            safe_filename = filename.replace('.', '_')
-            
-            if anchor == safe_filename:
-                target_file = filename
-                real_anchor = None
-                break
-            elif anchor.startswith(safe_filename + '__'):
-                target_file = filename
-                real_anchor = anchor[len(safe_filename) + 2:]
-                break
-        
-        if target_file:
-            if target_file == current_file:
-                # Should be internal link
-                if real_anchor:
-                    return f'[{text}](#{real_anchor})'
-                else:
-                    # Link to top of current file
-                    return f'[{text}](#)' # Or just remove link?
-            else:
-                # Cross-file link
-                if real_anchor:
-                    return f'[{text}]({target_file}#{real_anchor})'
-                else:
-                    return f'[{text}]({target_file})'
-        
-        # If not encoded, it's a regular internal link
-        return match.group(0)
+    # Every encoded link contains '](#'; skip the regex otherwise
+    if '](#' not in line:
+        return line
+    return _LINK_RE.sub(lambda match: _replace_link(match, current_file), line)
 
-    for line in content_lines:
-        new_line = link_pattern.sub(replace_link, line)
-        new_lines.append(new_line)
-        
-    return new_lines
+def _replace_attribute(match):
+    text = match.group(1)
+    attr = match.group(2).strip()
+    url = match.group(3)
+    return f'[{text}]({url}){{ {attr} }}'
 
-def restore_attributes(lines):
+def restore_attributes(line):
     """
     Restores attributes hidden in link text.
     [Text { #id }](url) -> [Text](url){ #id }
     """
-    new_lines = []
-    # Regex: [Text { #id }](url)
-    # We need to be careful about the text part.
-    # It ends with { #id }.
-    pattern = re.compile(r'\[(.*?) \{ *(#[^}]+) *\}\]\(([^)]+)\)')
-    
-    def replace(match):
-        text = match.group(1)
-        attr = match.group(2).strip()
-        url = match.group(3)
-        return f'[{text}]({url}){{ {attr} }}'
+    if '](' not in line or '{' not in line:
+        return line
+    return _ATTR_RE.sub(_replace_attribute, line)
 
-    for line in lines:
-        new_line = pattern.sub(replace, line)
-        new_lines.append(new_line)
-    return new_lines
+def _replace_cb(match):
+    cb_id = match.group(1)
+    return f"<input type='checkbox' checked id=\"{cb_id}\" class=\"cb-sa\" onchange=\"toggleCheckboxes(event)\"/>"
+
+def _replace_pledge(match):
+    pledge_name = match.group(1)
+    return f"<input type='checkbox' checked name=\"{pledge_name}\" class=\"data-input\" />"
 
-def restore_checkboxes(lines):
+def restore_checkboxes(line):
     """
     Restores [id] or [name] to <input ...> tags.
     """
-    new_lines = []
-    # Regex for [cb-...]
-    cb_pattern = re.compile(r'\[(cb-[^\]]+)\]')
-    # Regex for [pledge_...]
-    pledge_pattern = re.compile(r'\[(pledge_[^\]]+)\]')
-    
-    for line in lines:
-        # Check for cb- ID
-        if cb_pattern.search(line):
-            def replace_cb(match):
-                cb_id = match.group(1)
-                return f"<input type='checkbox' checked id=\"{cb_id}\" class=\"cb-sa\" onchange=\"toggleCheckboxes(event)\"/>"
-            line = cb_pattern.sub(replace_cb, line)
-            
-        # Check for pledge_ NAME
-        if pledge_pattern.search(line):
-            def replace_pledge(match):
-                pledge_name = match.group(1)
-                return f"<input type='checkbox' checked name=\"{pledge_name}\" class=\"data-input\" />"
-            line = pledge_pattern.sub(replace_pledge, line)
-            
-        new_lines.append(line)
-    return new_lines
+    # Check for cb- ID
+    if '[cb-' in line:
+        line = _CB_RE.sub(_replace_cb, line)
+    # Check for pledge_ NAME
+    if '[pledge_' in line:
+        line = _PLEDGE_RE.sub(_replace_pledge, line)
+    return line
+
+def _restore_line(line, current_file):
+    line = restore_links(line, current_file)
+    line = restore_attributes(line)
+    return restore_checkboxes(line)
+
+# Many lines repeat (blank lines, ///, type: ..., list markers), so restored
+# lines are cached by content and file
+_restore_line_cached = functools.lru_cache(maxsize=8192)(_restore_line)
+
+def restore_line(line, current_file):
+    """
+    Restores links, attributes and checkboxes of a single line, in that order.
+    """
+    # Checkbox ids and pledge names are unique; caching them only evicts useful entries
+    if '[cb-' in line or '[pledge_' in line:
+        return _restore_line(line, current_file)
+    return _restore_line_cached(line, current_file)
 
 def clean_buffer(lines):
     """
     Post-process lines to merge metadata and inputs that were split by blank lines.
     Also removes leading blank lines.
     """
+    # Strip every line once; the checks below reuse the stripped copies
+    stripped = [line.strip() for line in lines]
+    
     # Remove leading blank lines
-    while lines and lines[0].strip() == '':
-        lines.pop(0)
+    start = 0
+    while start < len(lines) and stripped[start] == '':
+        start += 1
+    lines = lines[start:]
+    stripped = stripped[start:]
+    
+    # Look ahead table: index of the first non-blank line at or after k
+    # (None if there is none), filled backwards in a single pass
+    next_non_blank = [None] * (len(lines) + 1)
+    for k in range(len(lines) - 1, -1, -1):
+        next_non_blank[k] = k if stripped[k] != '' else next_non_blank[k + 1]
         
     cleaned = []
+    append = cleaned.append
     i = 0
     while i < len(lines):
         line = lines[i]
         
-        # Helper to look ahead skipping blanks
-        def find_next_non_blank(start_idx):
-            k = start_idx
-            while k < len(lines) and lines[k].strip() == '':
-                k += 1
-            if k < len(lines):
-                return k, lines[k]
-            return None, None
-
-        next_idx, next_line = find_next_non_blank(i + 1)
+        next_idx = next_non_blank[i + 1]
         
         if next_idx:
+            next_line = lines[next_idx]
+            next_stripped = stripped[next_idx]
+            
             # Merge /// details and type:
             if '/// details' in line and 'type:' in next_line:
-                cleaned.append(line)
+                append(line)
                 # Don't append next_line yet, let it be processed in next iteration
                 # so it can be merged with open: if needed
                 i = next_idx
@@ -347,88 +361,86 @@ def clean_buffer(lines):
 
             # Merge type: and open:
             if 'type:' in line and 'open:' in next_line:
-                cleaned.append(line)
-                cleaned.append(next_line)
+                append(line)
+                append(next_line)
                 i = next_idx + 1
                 continue
 
             # Ensure blank line after metadata if followed by text
-            if ('type:' in line or 'open:' in line) and next_line.strip() != '' and not next_line.strip().startswith('open:') and not next_line.strip().startswith('///'):
-                 cleaned.append(line)
-                 cleaned.append('') # Force blank line
-                 cleaned.append(next_line)
+            if ('type:' in line or 'open:' in line) and next_stripped != '' and not next_stripped.startswith('open:') and not next_stripped.startswith('///'):
+                 append(line)
+                 append('') # Force blank line
+                 append(next_line)
                  i = next_idx + 1
                  continue
                 
             # Ensure blank line after /// html | li
             if '/// html' in line and 'li' in line:
-                 cleaned.append(line)
-                 if i + 1 < len(lines) and lines[i+1].strip() != '':
-                     cleaned.append('')
+                 append(line)
+                 if i + 1 < len(lines) and stripped[i+1] != '':
+                     append('')
                  i += 1
                  continue
                  
             # Merge <input> or [cb-...] or [pledge_...] and following text
             # Only if it is on its own line (which it is if we split it)
             is_input = '<input' in line or '[cb-' in line or '[pledge_' in line
-            if is_input and next_line.strip() != '':
+            if is_input and next_stripped != '':
                  # Check if it was split by us (i.e. there was a blank line)
                  # If next_idx > i + 1, there was a blank line.
                  if next_idx > i + 1:
-                     cleaned.append(line)
-                     cleaned.append(next_line)
+                     append(line)
+                     append(next_line)
                      i = next_idx + 1
                      continue
         
-        cleaned.append(line)
+        append(line)
         i += 1
     return cleaned
 
+def write_lines(filepath, lines):
+    """
+    Writes lines joined by newlines, streaming them to the file.
+    
+    Clean up multiple blank lines: the export process added blank lines, so
+    runs of 3+ newlines are reduced to 2 while writing, without building the
+    whole file content as one string.
+    """
+    newlines = 0
+    first = True
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for line in lines:
+            if not first:
+                newlines += 1
+            first = False
+            if line:
+                f.write('\n\n' if newlines >= 3 else '\n' * newlines)
+                f.write(line)
+                newlines = 0
+        f.write('\n\n' if newlines >= 3 else '\n' * newlines)
+
 def main():
     print("Converting DOCX to Markdown...")
     # Convert DOCX to Markdown
     # We use 'markdown' format (pandoc's markdown)
     # We enable 'raw_html' to ensure HTML tags are preserved if they exist?
     # Actually, we want to process the text representation.
-    content = pypandoc.convert_file(INPUT_DOCX, 'markdown', format='docx', extra_args=['--wrap=none'])
-    
-    # Save debug
-    with open('debug_import_full.md', 'w', encoding='utf-8') as f:
-        f.write(content)
-        
-    print("Building anchor map...")
-    anchor_map = build_anchor_map(content)
-    # print("Anchor map:", anchor_map)
+    # Pandoc writes the markdown straight to disk; it is then read back line by
+    # line instead of being held as one string.
+    pypandoc.convert_file(INPUT_DOCX, 'markdown', format='docx', outputfile=IMPORT_MD, extra_args=['--wrap=none'])
     
     print("Processing content...")
-    files_content = process_content(content, anchor_map)
+    files_content = process_content(read_lines(IMPORT_MD))
     
     for filename, lines in files_content.items():
         print(f"Restoring {filename}...")
         
-        # Restore links
-        lines = restore_links(lines, anchor_map, filename)
-        
-        # Restore attributes
-        lines = restore_attributes(lines)
-        
-        # Restore checkboxes
-        lines = restore_checkboxes(lines)
-        
-        # Join lines
-        file_content = '\n'.join(lines)
-        
-        # Clean up multiple blank lines?
-        # The export process added blank lines.
-        # We might want to reduce 3+ newlines to 2.
-        file_content = re.sub(r'\n{3,}', '\n\n', file_content)
-        
         # Write to file
         filepath = os.path.join(DOCS_DIR, filename)
         # We might want to backup original files first?
         # For now, overwrite.
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(file_content)
+        # Links, attributes and checkboxes are restored line by line as the file is written
+        write_lines(filepath, (restore_line(line, filename) for line in lines))
             
     print("Import complete.")
 